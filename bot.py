@@ -1,15 +1,22 @@
 import asyncio
+import contextlib
+import functools
+import hashlib
+import heapq
 import logging
 import os
 import re
-from datetime import datetime, timedelta
+import time
+from datetime import date, datetime
+from typing import NamedTuple
 from zoneinfo import ZoneInfo
 
-import requests
-from bs4 import BeautifulSoup
+import aiohttp
 from aiogram import Bot
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from aiogram.client.session.aiohttp import AiohttpSession
+from aiolimiter import AsyncLimiter
 from dotenv import load_dotenv
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_exponential_jitter
 
 # ----------------------
 # Load configuration
@@ -39,159 +46,363 @@ logging.basicConfig(
 )
 logger = logging.getLogger("forex-bot")
 
-bot = Bot(token=API_TOKEN)
-scheduler = AsyncIOScheduler(timezone=tz)
+# Одна постоянная сессия (и пул соединений) к api.telegram.org на всё время работы
+bot = Bot(token=API_TOKEN, session=AiohttpSession(limit=4, timeout=30))
+# Telegram ограничивает ~30 сообщений/с на бота — держим запас
+TG_LIMITER = AsyncLimiter(25, 1)
 
-# Хранилище запланированных уведомлений (чтобы не дублировать)
+class Event(NamedTuple):
+    id: str
+    currency: str
+    title: str
+    event_dt: datetime
+    forecast: str
+    previous: str
+
+# HTTP-сессия к ForexFactory (создаётся в main(), переиспользует TCP/TLS между опросами)
+SESSION: aiohttp.ClientSession | None = None
+
+HEADERS = {
+    "User-Agent": "Mozilla/5.0 (compatible; ForexAlertBot/1.0)",
+    "Accept-Language": "en-US,en;q=0.9",
+    "Accept-Encoding": "gzip, deflate, br",
+    "Cache-Control": "no-cache",
+    "Connection": "keep-alive",
+}
+
+# Валидаторы последнего ответа календаря и разобранные по нему события (для условного GET)
+LAST_ETAG: str | None = None
+LAST_MODIFIED: str | None = None
+LAST_EVENTS: list[Event] = []
+# Дата (в TIMEZONE), от которой построены event_dt в LAST_EVENTS; в другой день кеш недействителен
+LAST_PARSE_DATE: date | None = None
+# Хеш тела последней разобранной страницы — на случай, если сервер не отдаёт 304
+LAST_BODY_HASH: bytes | None = None
+
+# Очередь уведомлений: куча (notify_at_ts, event_id, event), на вершине — ближайшее
+NOTIFY_HEAP: list[tuple[float, str, Event]] = []
+# Опоздание, после которого уведомление уже не отправляется (сек)
+MISFIRE_GRACE_SEC = 60
+
+# Лимит длины одного сообщения Telegram и разделитель уведомлений в общем сообщении
+TG_MESSAGE_LIMIT = 4096
+MESSAGE_SEPARATOR = "\n\n—\n\n"
+
+# Хранилище запланированных уведомлений (чтобы не дублировать).
+# Содержит только id из NOTIFY_HEAP: при отправке id удаляется, повторно такое
+# событие не попадёт в очередь, т.к. минута его notify_at уже наступила.
 SCHEDULED_IDS: set[str] = set()
 
-TIME_PATTERNS = [
-    "%I:%M%p",  # 8:30am
-    "%I%p",     # 8am
-]
-
-def parse_forex_calendar():
-    headers = {
-        'User-Agent': 'Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/125.0.0.0 Safari/537.36',
-        'Accept': 'text/html,application/xhtml+xml,application/xml;q=0.9,image/webp,*/*;q=0.8',
-        'Accept-Language': 'en-US,en;q=0.9,ru;q=0.8',
-        'Connection': 'keep-alive',
-        'Upgrade-Insecure-Requests': '1',
-        'DNT': '1',
-        'Sec-Fetch-Dest': 'document',
-        'Sec-Fetch-Mode': 'navigate',
-        'Sec-Fetch-Site': 'none',
-        'Sec-Fetch-User': '?1',
-        'TE': 'trailers'
-    }
-    try:
-        response = requests.get(url, headers=headers, timeout=10)
-        response.raise_for_status()
-        soup = BeautifulSoup(response.text, 'html.parser')
-        # ... остальной код
-    except Exception as e:
-        print(f"Ошибка: {e}")
-        return []
-
-def _cell_text(el) -> str:
-    if not el:
-        return ""
-    return re.sub(r"\s+", " ", el.get_text(" ", strip=True)).strip()
-
-def _row_has_high_impact(row) -> bool:
-    # Пытаемся детектить 'красные' новости по возможным классам/текстам.
-    impact_el = row.select_one(
-        ".calendar__impact-icon--high, .impact__icon--high, .impact.high, td.impact span.high, .ff-impact--high"
-    )
-    if impact_el:
-        return True
-    impact_cell = row.select_one(".calendar__impact, td.impact")
-    if impact_cell and "high" in impact_cell.get_text(" ", strip=True).lower():
-        return True
-    return False
-
-def fetch_events() -> list[dict]:
+# Время в календаре: "8:30am" или "8am"; "All Day", "Tentative" и т.п. не подходят
+_TIME_RE = re.compile(r"^(\d{1,2})(?::(\d{2}))?\s*(am|pm)$", re.I)
+
+def _cls(name: str) -> str:
+    # XPath-аналог CSS-селектора ".name": точное совпадение одного из классов
+    return f"contains(concat(' ', normalize-space(@class), ' '), ' {name} ')"
+
+# Пытаемся детектить 'красные' новости по возможным классам/текстам.
+_HIGH_IMPACT = (
+    f".//*[{_cls('calendar__impact-icon--high')} or {_cls('impact__icon--high')}"
+    f" or ({_cls('impact')} and {_cls('high')}) or {_cls('ff-impact--high')}]"
+    f" or .//td[{_cls('impact')}]//span[{_cls('high')}]"
+    f" or .//*[{_cls('calendar__impact')} or (self::td and {_cls('impact')})]"
+    f"[contains(translate(., 'HIGH', 'high'), 'high')]"
+)
+
+# Варианты класса строки календаря, встречавшиеся в вёрстке ForexFactory
+_ROW_CLASSES = ("calendar__row", "calendar_row", "calendar-row")
+# Класс строк, выученный на реальной странице (None — ещё не выучен или вёрстка поменялась)
+_LEARNED_ROW_CLASS: str | None = None
+
+@functools.cache
+def _row_xpath(row_class: str | None = None):
+    # lxml импортируется при первом разборе, а не при старте процесса
+    from lxml import etree
+    cond = f"[{_cls(row_class)}]" if row_class else ""
+    return etree.XPath(f"//tr{cond}[{_HIGH_IMPACT}]")
+
+def _select_rows(tree) -> list:
+    # После первого удачного разбора используется только выученный класс строк;
+    # если по нему ничего не нашлось, вёрстка могла смениться — определяем заново.
+    global _LEARNED_ROW_CLASS
+    if _LEARNED_ROW_CLASS is not None:
+        rows = _row_xpath(_LEARNED_ROW_CLASS)(tree)
+        if rows:
+            return rows
+        logger.info("Строки tr.%s не найдены, заново определяем вёрстку", _LEARNED_ROW_CLASS)
+        _LEARNED_ROW_CLASS = None
+
+    rows = _row_xpath()(tree)
+    if not rows:
+        return rows
+    for row_class in _ROW_CLASSES:
+        # Класс выучивается, только если покрывает все найденные строки
+        if len(_row_xpath(row_class)(tree)) == len(rows):
+            _LEARNED_ROW_CLASS = row_class
+            logger.info("Вёрстка календаря: строки tr.%s", row_class)
+            break
+    return rows
+
+# Роли ячеек строки по подстроке в классе <td> (первое совпадение побеждает)
+_TD_ROLES = (
+    ("currency", "currency"),
+    ("event", "title"),
+    ("time", "time"),
+    ("forecast", "forecast"),
+    ("previous", "previous"),
+)
+
+@functools.lru_cache(maxsize=256)
+def _td_role(cls: str) -> str | None:
+    # На странице всего несколько разных class у <td>, поэтому разбор кешируется
+    for marker, role in _TD_ROLES:
+        if marker in cls:
+            return role
+    return None
+
+def _row_cells(row) -> dict[str, str]:
+    # Один проход по <td> строки: текст каждой ячейки раскладывается по её роли
+    cells: dict[str, str] = {}
+    for td in row.iterchildren("td"):
+        role = _td_role(td.get("class", ""))
+        if role and role not in cells:
+            cells[role] = " ".join(td.text_content().split())
+    return cells
+
+# Общий хвост классов high-impact иконок (calendar__impact-icon--high, impact__icon--high, ff-impact--high)
+_HIGH_MARKER = b"--high"
+
+def _high_impact_rows_html(body: bytes) -> bytes | None:
+    # Вырезает из сырого HTML только те <tr>...</tr>, внутри которых встречается маркер,
+    # чтобы lxml разбирал десяток строк, а не всю страницу. None — маркеров в строках нет.
+    parts: list[bytes] = []
+    pos = 0
+    while (off := body.find(_HIGH_MARKER, pos)) != -1:
+        start = body.rfind(b"<tr", 0, off)
+        end = body.find(b"</tr>", off)
+        if start == -1 or end == -1 or body.rfind(b"</tr>", start, off) != -1:
+            # Маркер вне строки таблицы (например, в CSS)
+            pos = off + len(_HIGH_MARKER)
+            continue
+        end += len(b"</tr>")
+        parts.append(body[start:end])
+        pos = end
+    if not parts:
+        return None
+    return b"<table>" + b"".join(parts) + b"</table>"
+
+def _parse_time_to_dt(time_str: str, base_date: datetime) -> datetime | None:
+    m = _TIME_RE.match(time_str.strip())
+    if not m:
+        return None
+    hour, minute = int(m[1]), int(m[2] or 0)
+    if not 1 <= hour <= 12 or minute > 59:
+        return None
+    hour %= 12
+    if m[3].lower() == "pm":
+        hour += 12
+    return base_date.replace(hour=hour, minute=minute)
+
+def _is_transient(exc: BaseException) -> bool:
+    # Сетевые сбои, таймауты, 5xx и 429 имеет смысл повторить; прочие 4xx — нет
+    if isinstance(exc, aiohttp.ClientResponseError):
+        return exc.status >= 500 or exc.status == 429
+    return isinstance(exc, (aiohttp.ClientError, asyncio.TimeoutError))
+
+@retry(
+    stop=stop_after_attempt(3),
+    wait=wait_exponential_jitter(initial=1, max=10),
+    retry=retry_if_exception(_is_transient),
+    reraise=True,
+)
+async def fetch_events() -> list[Event]:
     # Парсит ForexFactory Calendar и возвращает список событий за сегодня:
-    # [ {id, currency, title, event_dt, forecast, previous}, ... ]
-    headers = {
-        "User-Agent": "Mozilla/5.0 (compatible; ForexAlertBot/1.0)",
-        "Accept-Language": "en-US,en;q=0.9",
-        "Cache-Control": "no-cache",
-    }
-    resp = requests.get(URL, headers=headers, timeout=30)
-    resp.raise_for_status()
-
-    soup = BeautifulSoup(resp.text, "html.parser")
-
-    events: list[dict] = []
+    # [ Event(id, currency, title, event_dt, forecast, previous), ... ]
+    global LAST_ETAG, LAST_MODIFIED, LAST_EVENTS, LAST_BODY_HASH, LAST_PARSE_DATE
+    import lxml.html
+
     today = datetime.now(tz).replace(hour=0, minute=0, second=0, microsecond=0)
+    # После локальной полуночи события надо пересобрать от новой даты, даже если
+    # сама страница не изменилась: ни 304, ни совпавший хеш тела тогда не годятся
+    cache_fresh = LAST_PARSE_DATE == today.date()
 
-    rows = soup.select("tr.calendar__row, tr.calendar_row, tr.calendar-row, tr")
-    for row in rows:
-        if not _row_has_high_impact(row):
-            continue
+    headers = {}
+    if cache_fresh and LAST_ETAG:
+        headers["If-None-Match"] = LAST_ETAG
+    if cache_fresh and LAST_MODIFIED:
+        headers["If-Modified-Since"] = LAST_MODIFIED
+
+    async with SESSION.get(URL, headers=headers) as resp:
+        if resp.status == 304:
+            # Страница не менялась с прошлого опроса — тело пустое, разбирать нечего
+            return LAST_EVENTS
+        resp.raise_for_status()
+        body = await resp.read()
+        charset = resp.charset or "utf-8"
+        etag = resp.headers.get("ETag")
+        modified = resp.headers.get("Last-Modified")
+        logger.info("Календарь загружен: %d байт (по сети: %s, Content-Encoding: %s)",
+                    len(body), resp.content_length or "?", resp.headers.get("Content-Encoding", "identity"))
+
+    body_hash = hashlib.blake2b(body, digest_size=16).digest()
+    if cache_fresh and body_hash == LAST_BODY_HASH:
+        LAST_ETAG, LAST_MODIFIED = etag, modified
+        return LAST_EVENTS
+
+    rows_html = _high_impact_rows_html(body)
+    if rows_html is not None:
+        # У фрагмента нет <meta charset>, поэтому кодировку берём из ответа
+        tree = lxml.html.fromstring(rows_html, parser=lxml.html.HTMLParser(encoding=charset))
+    else:
+        # Иконок с маркером нет — возможно, другая вёрстка; разбираем страницу целиком
+        tree = lxml.html.fromstring(body)
+
+    events: list[Event] = []
 
-        currency = _cell_text(row.select_one(".calendar__currency, td.currency, .currency"))
+    for row in _select_rows(tree):
+        cells = _row_cells(row)
+        currency = cells.get("currency", "")
         if not currency or currency.upper() not in CURRENCIES:
             continue
 
-        title = _cell_text(row.select_one(".calendar__event-title, td.event, .event"))
+        title = cells.get("title", "")
         if not title:
             continue
 
-        time_str = _cell_text(row.select_one(".calendar__time, td.time, .time"))
+        time_str = cells.get("time", "")
         event_dt = _parse_time_to_dt(time_str, base_date=today)
         if event_dt is None:
             continue
 
-        forecast = _cell_text(row.select_one(".calendar__forecast, td.forecast, .forecast")) or "—"
-        previous = _cell_text(row.select_one(".calendar__previous, td.previous, .previous")) or "—"
+        forecast = cells.get("forecast") or "—"
+        previous = cells.get("previous") or "—"
 
         event_id = f"{event_dt.isoformat()}|{currency}|{title}".lower()
 
-        events.append({
-            "id": event_id,
-            "currency": currency.upper(),
-            "title": title,
-            "event_dt": event_dt,
-            "forecast": forecast,
-            "previous": previous,
-        })
+        events.append(Event(
+            id=event_id,
+            currency=currency.upper(),
+            title=title,
+            event_dt=event_dt,
+            forecast=forecast,
+            previous=previous,
+        ))
 
+    LAST_ETAG, LAST_MODIFIED, LAST_EVENTS, LAST_BODY_HASH = etag, modified, events, body_hash
+    LAST_PARSE_DATE = today.date()
     return events
 
-async def notify(event: dict):
-    text = (
-        f"⚠️ Через {LEAD_MINUTES} мин выйдет новость по <b>{event['currency']}</b>\n\n"
-        f"<b>{event['title']}</b>\n"
-        f"⏰ Время выхода: <b>{event['event_dt'].strftime('%H:%M')}</b>\n"
-        f"📊 Прогноз: <b>{event['forecast']}</b>\n"
-        f"📉 Предыдущее: <b>{event['previous']}</b>"
+def _format_event(event: Event) -> str:
+    return (
+        f"⚠️ Через {LEAD_MINUTES} мин выйдет новость по <b>{event.currency}</b>\n\n"
+        f"<b>{event.title}</b>\n"
+        f"⏰ Время выхода: <b>{event.event_dt.strftime('%H:%M')}</b>\n"
+        f"📊 Прогноз: <b>{event.forecast}</b>\n"
+        f"📉 Предыдущее: <b>{event.previous}</b>"
     )
-    try:
-        await bot.send_message(int(CHAT_ID), text, parse_mode="HTML", disable_web_page_preview=True)
-    except Exception as e:
-        logger.exception("Ошибка отправки в Telegram: %s", e)
 
-def schedule_notifications(events: list[dict]):
-    now = datetime.now(tz)
+def _pack_messages(texts: list[str]) -> list[str]:
+    # Склеивает тексты через разделитель, не превышая лимит длины сообщения Telegram
+    messages: list[str] = []
+    current = ""
+    for text in texts:
+        candidate = f"{current}{MESSAGE_SEPARATOR}{text}" if current else text
+        if current and len(candidate) > TG_MESSAGE_LIMIT:
+            messages.append(current)
+            current = text
+        else:
+            current = candidate
+    if current:
+        messages.append(current)
+    return messages
+
+async def notify_batch(events: list[Event]):
+    # Все уведомления одной минуты уходят одним сообщением (или несколькими, если не влезают)
+    for text in _pack_messages([_format_event(ev) for ev in events]):
+        try:
+            async with TG_LIMITER:
+                await bot.send_message(int(CHAT_ID), text, parse_mode="HTML", disable_web_page_preview=True)
+        except Exception as e:
+            logger.exception("Ошибка отправки в Telegram: %s", e)
+
+def schedule_notifications(events: list[Event]):
+    # Все сравнения — в POSIX-секундах; datetime нужен только для лога
+    now = time.time()
+    lead_sec = LEAD_MINUTES * 60
     for ev in events:
-        notify_at = ev["event_dt"] - timedelta(minutes=LEAD_MINUTES)
-        if notify_at <= now:
+        notify_at_ts = ev.event_dt.timestamp() - lead_sec
+        # Минута уже наступила — её пачка отправлена (или отправляется) целиком
+        if notify_at_ts // 60 * 60 <= now:
             continue
-        if ev["id"] in SCHEDULED_IDS:
+        if ev.id in SCHEDULED_IDS:
             continue
-        scheduler.add_job(
-            notify,
-            "date",
-            run_date=notify_at,
-            args=[ev],
-            id=ev["id"],
-            misfire_grace_time=60,
-            coalesce=True,
-        )
-        SCHEDULED_IDS.add(ev["id"])
-        logger.info("Запланировано: %s @ %s", ev["title"], notify_at.astimezone(tz).strftime("%Y-%m-%d %H:%M"))
+        heapq.heappush(NOTIFY_HEAP, (notify_at_ts, ev.id, ev))
+        SCHEDULED_IDS.add(ev.id)
+        logger.info("Запланировано: %s @ %s", ev.title,
+                    datetime.fromtimestamp(notify_at_ts, tz).strftime("%Y-%m-%d %H:%M"))
+
+async def notification_loop():
+    # Единственная задача-планировщик: спит до ближайшего notify_at и отправляет уведомления
+    while True:
+        now = time.time()
+        if NOTIFY_HEAP and NOTIFY_HEAP[0][0] <= now:
+            # Забираем всё, что приходится на ту же минуту, что и вершина кучи
+            minute = NOTIFY_HEAP[0][0] // 60
+            batch: list[Event] = []
+            while NOTIFY_HEAP and NOTIFY_HEAP[0][0] // 60 == minute:
+                notify_at_ts, event_id, ev = heapq.heappop(NOTIFY_HEAP)
+                SCHEDULED_IDS.discard(event_id)
+                if now - notify_at_ts > MISFIRE_GRACE_SEC:
+                    logger.warning("Пропущено (опоздание %.0f с): %s", now - notify_at_ts, ev.title)
+                    continue
+                batch.append(ev)
+            if batch:
+                await notify_batch(batch)
+        else:
+            await asyncio.sleep(min(NOTIFY_HEAP[0][0] - now, 60) if NOTIFY_HEAP else 60)
 
 async def poll_and_schedule():
     try:
-        events = await asyncio.to_thread(fetch_events)
+        events = await fetch_events()
     except Exception as e:
         logger.exception("Ошибка загрузки календаря: %s", e)
         return
     schedule_notifications(events)
 
+async def polling_loop():
+    while True:
+        await poll_and_schedule()
+        await asyncio.sleep(POLL_INTERVAL_MIN * 60)
+
 async def main():
+    global SESSION
     logger.info("Старт бота. TZ=%s; CURRENCIES=%s; POLL_INTERVAL_MIN=%s; LEAD_MINUTES=%s",
                 TIMEZONE, ",".join(CURRENCIES), POLL_INTERVAL_MIN, LEAD_MINUTES)
-    await poll_and_schedule()
-    scheduler.add_job(poll_and_schedule, "interval", minutes=POLL_INTERVAL_MIN, next_run_time=None)
-    scheduler.start()
-    while True:
-        await asyncio.sleep(60)
+    SESSION = aiohttp.ClientSession(
+        headers=HEADERS,
+        timeout=aiohttp.ClientTimeout(total=30),
+        connector=aiohttp.TCPConnector(limit=4, ttl_dns_cache=300, keepalive_timeout=75),
+    )
+    tasks = [asyncio.create_task(polling_loop()), asyncio.create_task(notification_loop())]
+    try:
+        # Оба цикла бесконечные: завершение любого из них — сбой, который нельзя
+        # тихо проглотить (опрос продолжался бы, а уведомления — нет)
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+        failed = done.pop()
+        logger.error("Задача %s остановилась, завершаем бота", failed.get_coro().__name__,
+                     exc_info=failed.exception())
+        raise SystemExit(1)
+    finally:
+        for task in tasks:
+            task.cancel()
+        for task in tasks:
+            with contextlib.suppress(asyncio.CancelledError, Exception):
+                await task
+        await SESSION.close()
+        await bot.session.close()
 
 if __name__ == "__main__":
     try:
         asyncio.run(main())
-    except (KeyboardInterrupt, SystemExit):
+    except KeyboardInterrupt:
         pass